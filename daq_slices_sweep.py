@@ -12,7 +12,8 @@ Usage:
 
 Dependencies:
     - numpy
-    - ROOT (with PyROOT)
+    - numba
+    - threadpoolctl
     - dsutils, dselec, dsio, dsdetector (from iv-dslab repo)
     - pathlib
     - argparse
@@ -20,19 +21,86 @@ Dependencies:
 """
 import argparse as ap
 import logging
+import multiprocessing
 import numpy as np
+import os
+import queue
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from dsutils import nu, set_random_seeds, concat_recarrays
+from numba import set_num_threads
+from threadpoolctl import threadpool_limits
+from dsutils import nu, set_random_seeds, setup_logging, concat_recarrays
 from dselec import *
 from dsio import *
 from dsdetector import tpc_chmap
-import ROOT
-from ROOT import TH1F, TFile
 
 logger = logging.getLogger(__name__)
 
-def process_event(i, ev, out):
+_SENTINEL = object()
+
+# Sweep value currently applied to elec_cfg, and cached process_event settings per value (one per process)
+_current_value = None
+_value_settings = {}
+
+# Number of events whose results may wait to be written, at least enough to keep every worker busy
+_MAX_PENDING_EVENTS = 16
+
+# Sweep parameters that cannot change the waveform gates: they only describe the electronics and dark
+# noise added after the gates are found. Gates are found per value for every other parameter.
+_GATE_INDEPENDENT_PARAMS = {'snr', 'noise_spectrum', 'dcr'}
+
+def prefetch(iterable, n=8, transform=None):
+    """
+    Iterate over 'iterable' while a background thread reads ahead, so that file I/O
+    in the reader overlaps with event processing. Closing the generator (or leaving a
+    for loop over it) stops the thread and waits for it, so the reader can then be closed.
+
+    Inputs:
+        iterable: Iterable to read from (e.g. a G4DSBinaryReader).
+        n (int): Maximum number of items to read ahead.
+        transform (callable): Applied to each item in the background thread, e.g. to copy
+            data out of buffers the reader may reuse. Items are passed unchanged if None.
+
+    Yields:
+        Items of 'iterable' (after 'transform'), in order. Exceptions raised by the reader are re-raised here.
+    """
+    q = queue.Queue(n)
+    stop = threading.Event()
+    
+    def put(x):
+        # Wait for room in the queue, giving up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def producer():
+        try:
+            for x in iterable:
+                if not put(x if transform is None else transform(x)):
+                    return
+        except Exception as e:
+            put(e)
+        put(_SENTINEL)
+    
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while (x := q.get()) is not _SENTINEL:
+            if isinstance(x, Exception):
+                raise x
+            yield x
+    finally:
+        stop.set()
+        thread.join()
+
+def process_event(i, ev, out, daq_slice, zle_gain, hit_gains, waveform_gates=None):
     """
     Process a single TPC event by simulating electronics, finding ZLEs, and identifying hits
     Same logic as daq_slices.py
@@ -40,20 +108,41 @@ def process_event(i, ev, out):
     Inputs:
         i (int): Event index
         ev (dict): Input event dictionary of PE data
-        out (dict): Output event dictionary to store results
+        out (dict): Output event dictionary to store results. out['pe'] is stored sorted by time.
+        daq_slice: 'daq.slice' electronics configuration
+        zle_gain (float): Mean ZLE integral gain used for normalization
+        hit_gains (tuple): Mean hit (integral, max) gains used for normalization
+        waveform_gates (tuple): (t_starts, gates) from find_waveform_gates, if already known. Found from 'ev' if None.
 
     Returns:
         bool: True if valid hits and ZLEs are found and written to 'out', False otherwise.
     """
-    hits, zles = [], []
     summed_wfs = None
-    t_starts, gates = find_waveform_gates(ev['pe'])
-    out['pe'] = add_noise_pes(ev['pe'], elec_cfg.get('daq.slice')) # add noise to PE data
+    t_starts, gates = find_waveform_gates(ev['pe']) if waveform_gates is None else waveform_gates
+    # One slot per gate plus one for the PEs outside gates; k counts the filled slots
+    hits, zles = [None] * (len(t_starts) + 1), [None] * (len(t_starts) + 1)
+    k = 0
+    zle_offset = 0 # running number of ZLEs in 'zles', used to offset hit zle_ids
+    out['pe'] = add_noise_pes(ev['pe'], daq_slice) # add noise to PE data
     add_daq_jitter(out['pe'])
+    if len(out['pe']) == 0:
+        logger.debug(f"Event {i}: no PEs after noise, skipping")
+        return False
+    
+    # Sort PEs by time once so each gate is a contiguous slice. The time field is pulled
+    # out of the structured array so the sort and searches run on a plain contiguous array.
+    times = np.ascontiguousarray(out['pe']['time'])
+    order = np.argsort(times, kind='stable')
+    out['pe'], times = out['pe'][order], times[order]
+    # Each gate covers t_start <= time <= t_start + gate
+    t_starts, gates = np.asarray(t_starts), np.asarray(gates)
+    gate_ends = t_starts + gates
+    starts = times.searchsorted(t_starts, side='left')
+    stops = times.searchsorted(gate_ends, side='right')
     
-    for t_start, gate in zip(t_starts, gates):
+    for t_start, gate, lo, hi in zip(t_starts, gates, starts, stops):
         try:
-            pes = out['pe'][(out['pe']['time'] >= t_start) & (out['pe']['time'] <= t_start + gate)]
+            pes = out['pe'][lo:hi]
             logger.debug(f"Simulating waveform for t_start={t_start / nu.ms:.3f} ms, gate={gate / nu.us:.3f} us, NPE={len(pes)}")
             wfs = create_veto_waveforms(pes, gate, t_start)
             z = find_zle_intervals(wfs, t_start)
@@ -69,9 +158,10 @@ def process_event(i, ev, out):
                     raise e
                     
             h = find_hits(wfs, z, t_start)
-            h['zle_id'] += sum(len(_z) for _z in zles)
-            zles.append(z)
-            hits.append(h)
+            h['zle_id'] += zle_offset
+            zles[k], hits[k] = z, h
+            k += 1
+            zle_offset += len(z)
             
             # Save waveform data
             if summed_wfs is not None:
@@ -84,19 +174,21 @@ def process_event(i, ev, out):
     try:
         pes = get_pes_outside_gates(out['pe'], t_starts, gates)
         z, h = find_effective_zles_hits(pes)
-        h['zle_id'] += sum(len(_z) for _z in zles)
-        zles.append(z)
-        hits.append(h)
+        h['zle_id'] += zle_offset
+        zles[k], hits[k] = z, h
+        k += 1
+        zle_offset += len(z)
     except Exception as e:
         logger.warning(f"Event {i}: Error processing PEs outside gates: {str(e)}")
 
     # Only proceed if we have some valid data
-    if len(hits) > 0 and len(zles) > 0:
-        out['zles'] = concat_recarrays(zles) # combine zle data
-        out['hits'] = concat_recarrays(hits) # combine hit data
-        out['zles']['integral'] /= get_zle_gain_veto()['integral_mean']
-        for key in ['integral', 'max']:
-            out['hits'][key] /= get_hit_gain_veto()[f'{key}_mean']
+    if k > 0:
+        # combine zle and hit data
+        out['zles'] = concat_recarrays(zles[:k])
+        out['hits'] = concat_recarrays(hits[:k])
+        out['zles']['integral'] /= zle_gain
+        for key, gain in zip(['integral', 'max'], hit_gains):
+            out['hits'][key] /= gain
         out['hits'].sort(order=['zle_id', 'sample'])
         return True
     else:
@@ -132,9 +224,117 @@ def update_config_parameter(section, param, value):
         elif param in ['pre_trigger', 'post_trigger']:
             elec_cfg.set(f'zle.{param}', int(value))
 
-def process_with_params(input_path, output_base, section, param, values, **kwargs):
+def _worker_init(n_threads, log_level):
+    """
+    Set up a worker process: limit its BLAS/OpenMP and numba thread pools, so the workers together
+    do not oversubscribe the CPUs, and log at the same level as the main process.
+
+    Inputs:
+        n_threads (int): Number of threads each worker may use.
+        log_level (str): Logging level name (e.g. 'debug').
+    """
+    threadpool_limits(limits=n_threads)
+    # numba starts its own thread pool lazily, on the first parallel kernel, so threadpoolctl cannot see it
+    set_num_threads(n_threads)
+    setup_logging(level=log_level)
+
+def _configure_value(section, param, value):
+    """
+    Apply a sweep value to this process's electronics configuration and look up the
+    settings process_event needs. Settings are cached per value, so they are only looked
+    up once per worker process.
+
+    Inputs:
+        section (str): Configuration section to modify (e.g., 'daq').
+        param (str): Parameter to sweep (e.g., 'snr').
+        value: Parameter value to use.
+
+    Returns:
+        dict: Keyword arguments for process_event.
+    """
+    global _current_value
+    key = (section, param, value)
+    if _current_value != key:
+        update_config_parameter(section, param, value)
+        _current_value = key
+    if key not in _value_settings:
+        hit_gain = get_hit_gain_veto()
+        _value_settings[key] = {
+            'daq_slice': elec_cfg.get('daq.slice'),
+            'zle_gain': get_zle_gain_veto()['integral_mean'],
+            'hit_gains': (hit_gain['integral_mean'], hit_gain['max_mean']),
+        }
+    return _value_settings[key]
+
+def _process_cell(i, ev, out, section, param, value, seeds, waveform_gates):
+    """
+    Process a single event for a single parameter value. Runs in a worker process.
+
+    Inputs:
+        i (int): Event index
+        ev (dict): Input event dictionary of PE data
+        out (dict): Empty output event dictionary
+        section (str): Configuration section to modify (e.g., 'daq').
+        param (str): Parameter to sweep (e.g., 'snr').
+        value: Parameter value to use.
+        seeds (tuple): Numpy and numba random seeds for this event and value, or None to keep the current state.
+        waveform_gates (tuple): (t_starts, gates) shared by all values, or None to find them for this value.
+
+    Returns:
+        tuple: Result of process_event and the filled output event.
+    """
+    settings = _configure_value(section, param, value)
+    # Reseed per cell so the results do not depend on which worker processes the cell
+    if seeds is not None:
+        set_random_seeds(*seeds)
+    return process_event(i, ev, out, waveform_gates=waveform_gates, **settings), out
+
+def _submit_cell(executor, *args):
+    """
+    Run _process_cell in 'executor', or directly in this process if 'executor' is None.
+
+    Inputs:
+        executor (ProcessPoolExecutor): Pool to submit to, or None.
+        args: Arguments for _process_cell.
+
+    Returns:
+        Future: Future holding the result of _process_cell.
+    """
+    if executor is not None:
+        return executor.submit(_process_cell, *args)
+    future = Future()
+    try:
+        future.set_result(_process_cell(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _write_results(i, futures, fouts, valid_events, labels):
+    """
+    Wait for the results of one event and write them to the output files.
+
+    Inputs:
+        i (int): Event index
+        futures (list): One future from _process_cell per output file.
+        fouts (list): Output SliceWriters, one per parameter value.
+        valid_events (list): Number of valid events written to each output file, updated in place.
+        labels (list): Description of each parameter value, for logging.
+    """
+    for j, future in enumerate(futures):
+        try:
+            valid, out = future.result()
+        except Exception as e:
+            logger.error(f"Event {i}: Error processing {labels[j]}: {str(e)}")
+            continue
+        if valid:
+            fouts[j].write(out)
+            valid_events[j] += 1
+
+def process_with_params(input_path, output_base, section, param, values, workers=None, **kwargs):
     """
     Process the input file with different parameter values, saving results to separate output files.
+    The input file is read once; each event is processed for every parameter value in a pool of
+    worker processes. A single value, or a single worker, is processed in this process.
 
     Inputs:
         input_path (str): Path to the input file (.fil) files.
@@ -142,56 +342,94 @@ def process_with_params(input_path, output_base, section, param, values, **kwarg
         section (str): Configuration section to modify (e.g., 'daq'). Refer to dselec.ini
         param (str): Parameter to sweep (e.g., 'snr'). Refer to dselec.ini
         values (list): List of parameter values to sweep over.
+        workers (int): Number of worker processes. Defaults to the number of CPUs this process may run on.
 
     Outputs:
         - Output files are named as [output_base]_[section]_[param]_[value].slc.
     """
     # Create output directory
-    output_dir = Path(output_base).parent
+    output_base = Path(output_base)
+    output_dir = output_base.parent
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Get base name
-    base_name = Path(output_base).stem
-    extension = Path(output_base).suffix
+    # Create output filenames with parameter values
+    prefix = f"{output_base.stem}_{section}_{param}_"
+    output_paths = [output_dir / f"{prefix}{value}{output_base.suffix}" for value in values]
+    labels = [f"{section}.{param} = {value}" for value in values]
     
-    # Process for each parameter value
-    for value in values:
+    logger.info(f"Processing with {section}.{param} = {', '.join(str(v) for v in values)}")
+    fin = G4DSBinaryReader(input_path, **kwargs)
+    events = None
+    fouts = []
+    valid_events = [0] * len(values)
+    try:
+        for output_path in output_paths:
+            fouts.append(SliceWriter(str(output_path), header=fin.header))
+        daq_offset = elec_cfg.get('daq.offset')
+        
+        # Each worker process keeps its own copy of elec_cfg and sets the value of the cell it runs,
+        # so settings from one value cannot leak into another. Cells are (event, value) pairs, so the
+        # pool is sized by the CPUs allotted to this process (e.g. by a batch system), not by the number
+        # of values. With a single value or worker there is nothing to gain from shipping every event to
+        # a worker, so it runs here with the RNG state seeded in parse_args.
+        pending = deque()
+        n_cpus = len(os.sched_getaffinity(0))
+        n_workers = workers or n_cpus
+        in_process = len(values) == 1 or n_workers == 1
+        n_threads = max(1, n_cpus // n_workers)
+        # Workers are started from a forkserver rather than forked from this process, where the
+        # prefetch thread may be inside the reader at the time (forking with live threads can deadlock).
+        log_level = logging.getLevelName(logging.getLogger().getEffectiveLevel()).lower()
+        executor = None if in_process else ProcessPoolExecutor(max_workers=n_workers,
+                                                               mp_context=multiprocessing.get_context('forkserver'),
+                                                               initializer=_worker_init, initargs=(n_threads, log_level))
+        max_pending = max(_MAX_PENDING_EVENTS, 2 * n_workers // len(values))
         try:
-            # Update configuration
-            update_config_parameter(section, param, value)
-            
-            # Create output filename with parameter value
-            output_path = output_dir / f"{base_name}_{section}_{param}_{value}{extension}"
-            
-            # Process file
-            logger.info(f"Processing with {section}.{param} = {value}")
-            fin = G4DSBinaryReader(input_path, **kwargs)
-            fout = SliceWriter(str(output_path), header=fin.header)
-            
-            valid_events = 0
-            for i, ev in enumerate(fin):
-                ev['pe'] = ev['veto_pe']
+            # Copy the veto PEs while reading, in case the reader reuses its buffers for the next events
+            events = prefetch(fin, transform=lambda ev: ev['veto_pe'].copy())
+            for i, pe in enumerate(events):
                 logger.debug(f'Processing event {i}')
-                out = fout.create_empty_event()
-                ev['pe']['time'] += elec_cfg.get('daq.offset')
-                if process_event(i, ev, out):
-                    fout.write(out)
-                    valid_events += 1
-            
-            fin.close()
+                try:
+                    pe['time'] += daq_offset
+                    # Gates found here use whatever elec_cfg this process holds (the default, or the single
+                    # value when cells run in-process), so they are only shared by all values when the
+                    # swept parameter cannot affect them
+                    waveform_gates = find_waveform_gates(pe) if param in _GATE_INDEPENDENT_PARAMS else None
+                except Exception as e:
+                    logger.error(f"Event {i}: Error preparing event: {str(e)}")
+                    continue
+                futures = []
+                for value, fout in zip(values, fouts):
+                    seeds = None if in_process else tuple(int(x) for x in np.random.randint(0, 2**31 - 1, size=2))
+                    futures.append(_submit_cell(executor, i, {'pe': pe}, fout.create_empty_event(),
+                                                section, param, value, seeds, waveform_gates))
+                pending.append((i, futures))
+                # Write results in event order, keeping a bounded number of events in flight
+                while len(pending) > max_pending:
+                    _write_results(*pending.popleft(), fouts, valid_events, labels)
+        finally:
+            # Write out the events already submitted, also when reading stopped on an error
+            while pending:
+                _write_results(*pending.popleft(), fouts, valid_events, labels)
+            if executor is not None:
+                executor.shutdown()
+    except Exception as e:
+        logger.error(f"Error processing {section}.{param} sweep: {str(e)}")
+    finally:
+        if events is not None:
+            events.close() # stop the prefetch thread before closing the reader it reads from
+        fin.close()
+        for fout in fouts:
             fout.close()
-            
-            if valid_events > 0:
-                logger.info(f"Saved output to {output_path} ({valid_events} valid events)")
+        
+        for j, output_path in enumerate(output_paths):
+            if valid_events[j] > 0:
+                logger.info(f"Saved output to {output_path} ({valid_events[j]} valid events)")
             else:
-                logger.warning(f"No valid events processed for {section}.{param} = {value}")
+                logger.warning(f"No valid events processed for {labels[j]}")
                 # Remove empty output files
                 if output_path.exists():
                     output_path.unlink()
-                
-        except Exception as e:
-            logger.error(f"Error processing {section}.{param} = {value}: {str(e)}")
-            continue
 
 def parse_args(argv=None):
     """
@@ -212,6 +450,7 @@ def parse_args(argv=None):
     parser.add_argument('--start', default=ap.SUPPRESS, type=int, help='Event to start at.')
     parser.add_argument('--stop', default=ap.SUPPRESS, type=int, help='Event to stop at.')
     parser.add_argument('-s', '--seeds', type=int, nargs=2, default=[1234, 1235], help='Numpy and numba random seeds')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes for parameter sweeps. Defaults to the CPUs allotted to this job.')
     
     # Add parameter sweep arguments based on dselec.ini
     parser.add_argument('--snr', type=str, help='SNR values to sweep (comma-separated)')
@@ -241,6 +480,7 @@ def main(**kwargs):
     """
     input_path = kwargs.pop('input_path')
     output_base = kwargs.pop('output_base')
+    workers = kwargs.pop('workers', None)
     
     # Parameter mapping
     param_mapping = {
@@ -266,14 +506,13 @@ def main(**kwargs):
             else:
                 values = [float(x.strip()) for x in param_value.split(',')]
             logger.info(f"Sweeping {section}.{param} over values: {values}")
-            process_with_params(input_path, output_base, section, param, values)
+            process_with_params(input_path, output_base, section, param, values, workers=workers)
             return
     
     # If no parameter sweep specified, just process normally
-    process_with_params(input_path, output_base, 'daq', 'snr', [elec_cfg.get('daq.snr')])
+    process_with_params(input_path, output_base, 'daq', 'snr', [elec_cfg.get('daq.snr')], workers=workers)
 
 if __name__ == '__main__':
-    from dsutils import setup_logging
     setup_logging(level='debug')
     kwargs = parse_args()
     main(**kwargs) 
@@ -8,6 +8,7 @@ output_base="/data/darkside/simulation/B9_simulation/LeoDCR/final" # path for wh
 csv_base="/data/darkside/simulation/B9_simulation/NeutronAnalysis/g4ds_clusters/build/passed_sims" # read csv to find good sims to run
 
 Nsub=10
+ncpus=3 # CPUs per job, one worker process per DCR value
 
 for ((n_loc=0; n_loc < Nsub; n_loc++)); do
     input_dir="${base_dir}/PMMA_${n_loc}/output/fil_log_dep"
@@ -38,6 +39,7 @@ for ((n_loc=0; n_loc < Nsub; n_loc++)); do
     cat << EOF > submitter_ivdslab.sub
 universe = vanilla
 getenv = true
+request_cpus = ${ncpus}
 request_memory = 5 GB
 request_disk = 10 GB
 arguments = \$(ProcId) \$(ClusterId)
@@ -67,7 +69,7 @@ cd ${build_dir}
 echo "The file to be submitted is \${file_name}"
 
 # Run daq_slices_sweep.py to create slice files for each DCR value. Replace python script path with location of your daq_slices_sweep.py
-python -u /home/weihengliu/B9_simulations/iv-dslab/exe/daq_slices_sweep.py -i ${input_dir}/\${file_name}.fil -o ${dir}/slices/\${file_name}.slc --dcr 40,500,700
+python -u /home/weihengliu/B9_simulations/iv-dslab/exe/daq_slices_sweep.py -i ${input_dir}/\${file_name}.fil -o ${dir}/slices/\${file_name}.slc --dcr 40,500,700 --workers ${ncpus}
 
 EOF
 